@@ -2,10 +2,10 @@ import streamlit as st
 import pandas as pd
 from datetime import datetime, date, timedelta
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from io import BytesIO
 import urllib.parse
 import json # For storing list of dicts as string in GSheet
+from logic import connect_to_google_sheet
 # import xlsxwriter # Not directly imported if using pandas.ExcelWriter engine, but good to have installed
 
 # --- Page Configuration ---
@@ -58,10 +58,8 @@ def load_data_from_google_sheet(
 ):
     """Loads data from the specified Google Sheet."""
     try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/spreadsheets",
-                 "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
-        client = gspread.authorize(creds)
+        client = connect_to_google_sheet()
+        if client is None: return pd.DataFrame(columns=EXPECTED_COLUMN_ORDER)
         spreadsheet = client.open(sheet_name)
         worksheet = spreadsheet.get_worksheet(worksheet_index)
 
@@ -154,10 +152,8 @@ def update_gsheet_cells(worksheet, updates_list):
 
 def gsheet_update_wrapper(update_function, *args):
     try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/spreadsheets",
-                 "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
-        client = gspread.authorize(creds)
+        client = connect_to_google_sheet()
+        if client is None: return False
         spreadsheet = client.open(GSHEET_NAME)
         worksheet = spreadsheet.get_worksheet(WORKSHEET_INDEX)
         headers = worksheet.row_values(1)
@@ -388,10 +384,8 @@ def identify_overdue_reminders(df, days_threshold=2):
 def get_archived_reports_from_gsheet(archive_sheet_name, expected_headers):
     """Loads all archived reports from the specified Google Sheet archive tab."""
     try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/spreadsheets",
-                 "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
-        client = gspread.authorize(creds)
+        client = connect_to_google_sheet()
+        if client is None: return []
         spreadsheet = client.open(GSHEET_NAME)
         try:
             archive_ws = spreadsheet.worksheet(archive_sheet_name)
@@ -445,10 +439,8 @@ def get_last_report_date_from_archive(archived_reports):
 def save_report_to_gsheet_archive(report_data, archive_sheet_name_to_save, archive_headers_to_check):
     """Saves a single daily report to the specified Google Sheet archive."""
     try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/spreadsheets",
-                 "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
-        client = gspread.authorize(creds)
+        client = connect_to_google_sheet()
+        if client is None: return False
         spreadsheet = client.open(GSHEET_NAME)
         try:
             archive_ws = spreadsheet.worksheet(archive_sheet_name_to_save)
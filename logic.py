@@ -5,20 +5,18 @@ import time
 import datetime
 from datetime import date, timedelta
 import pandas as pd
-import openpyxl
-from openpyxl.drawing.image import Image as ExcelImage
+import numpy as np
 #import win32com.client
 #import pythoncom
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 import json
+import re
+import numbers
 from io import BytesIO
-import fitz # PyMuPDF for editing the credit card form
+from types import SimpleNamespace
 import urllib.parse
-import resend
-from fpdf import FPDF
-#import fitz
 import base64
 from datetime import datetime
 
@@ -46,20 +44,106 @@ BC_COMPANY = "PROD"
 BC_PAGE_ID = "70001"
 BC_RMA_FIELD_NAME = "No."
 BC_LINK_COL_NAME = "View in BC"
+TICKETS_SHEET_NAME = "Tickets"
+TICKET_BC_LINK_COL_NAME = "Business Central Link"
+TICKET_COLUMNS = ["Ticket ID", "Status", "RMA", "Serial Number", "Customer Email", "Subject", "Body"]
+RMA_REGEX = re.compile(r'(RMA\d+)', re.IGNORECASE)
 SOURCE_PARTS_ARCHIVE_DIR = "source_parts_archive" # <-- ADDED: New constant for the archive folder
 
 # =============================================================================
 # CORE GOOGLE SHEETS & DATA LOADING
 # =============================================================================
+def mount_pooled_adapter(client):
+    '''
+    Mounts a keep-alive connection pool with retries on a gspread client's HTTP session,
+    so every Sheets call reuses open TLS connections instead of re-handshaking.
+    '''
+    # gspread 6 keeps the session on client.http_client; older versions on the client itself
+    session = getattr(client, 'http_client', client).session
+    # Rate-limit (429) and transient 5xx answers are retried with backoff, honouring Retry-After;
+    # urllib3 only retries idempotent methods, so batchUpdate/append POSTs are never replayed
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return client
+
+def fetch_matching_rows(spreadsheet, worksheet, column_name, match, params=None, max_fraction=0.5, max_ranges=200):
+    '''
+    Reads the header row plus only the rows whose column_name cell satisfies match(value),
+    so a selective filter downloads a slice of the sheet instead of all of it. Falls back to
+    one full read when the column is missing, more than max_fraction of rows match, or the
+    matches are too scattered to request as at most max_ranges row spans.
+    Returns a list of rows, header first, like get_all_values().
+    '''
+    import gspread
+    def read(ranges):
+        response = spreadsheet.values_batch_get(
+            [gspread.utils.absolute_range_name(worksheet.title, r) for r in ranges], params=params
+        )
+        return [vr.get('values', []) for vr in response['valueRanges']]
+
+    def read_all():
+        return read([None])[0]
+
+    header_rows = read(['1:1'])[0]
+    headers = header_rows[0] if header_rows else []
+    if column_name not in headers:
+        return read_all()
+    col_letter = re.sub(r'\d+$', '', gspread.utils.rowcol_to_a1(1, headers.index(column_name) + 1))
+    column = read([f"{col_letter}2:{col_letter}"])[0]
+
+    rows = [i + 2 for i, cell in enumerate(column) if cell and match(cell[0])]
+    if not rows:
+        return [headers]
+    if len(rows) > max_fraction * len(column):
+        return read_all()
+
+    # Merge consecutive matches into spans to keep the request short
+    spans = []
+    for row in rows:
+        if spans and spans[-1][1] == row - 1:
+            spans[-1][1] = row
+        else:
+            spans.append([row, row])
+    if len(spans) > max_ranges:
+        return read_all()
+
+    matched = [headers]
+    for values in read([f"{start}:{end}" for start, end in spans]):
+        matched.extend(values)
+    return matched
+
+def parse_sheet_datetimes(col):
+    """Converts Sheets serial-number dates (and any dates stored as text) to datetimes."""
+    serials = pd.to_numeric(col, errors='coerce')
+    from_serials = pd.to_datetime(serials, unit='D', origin='1899-12-30')
+    from_text = pd.to_datetime(col.where(serials.isna()), errors='coerce')
+    return from_serials.fillna(from_text)
+
 @st.cache_resource
+def _authorized_client():
+    '''
+    Authorizes one shared gspread client with a pooled HTTP session. Raises on failure,
+    so only a working client is cached and the next call retries.
+    '''
+    # gspread and oauth2client (httplib2, google-auth, ...) are imported where they are used,
+    # so importing logic from a page doesn't pay for them up front
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    scopes = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
+              "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scopes)
+    return mount_pooled_adapter(gspread.authorize(creds))
+
 def connect_to_google_sheet():
-    '''Connects to Google Sheets using service account credentials.'''
+    '''
+    Returns the shared, cached Sheets client (one auth handshake per process), or None if
+    it can't be created. Failures aren't cached, so every page and helper sharing this
+    client recovers on its next call.
+    '''
     try:
-        # 'scopes' is defined here
-        scopes = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
-                  "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scopes) # and used here
-        return gspread.authorize(creds)
+        return _authorized_client()
     except Exception as e:
         st.error(f"Failed to connect to Google Sheets: {e}")
         return None
@@ -99,6 +183,7 @@ def load_data_from_google_sheet():
 
 def gsheet_update_wrapper(update_function, target_sheet_name, *args):
     '''A wrapper to handle GSheet connection for update operations.'''
+    import gspread
     client = connect_to_google_sheet()
     if not client: return False
     try:
@@ -143,6 +228,7 @@ def find_row_in_gsheet(worksheet, search_rma, search_sn, headers):
 @st.cache_data(ttl=600)
 def load_price_library():
     '''Loads the price library from Google Sheets into a dictionary.'''
+    import gspread
     client = connect_to_google_sheet()
     if not client:
         return {}
@@ -159,78 +245,83 @@ def load_price_library():
         st.error(f"Error loading Price Library: {e}")
         return {}
 
-def update_price_library_and_usage_count(parts_df):
+def _to_cell_data(value):
+    '''Converts a Python value into a Sheets API CellData payload.'''
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, numbers.Number) and not pd.isna(value):
+        return {'userEnteredValue': {'numberValue': float(value)}}
+    return {'userEnteredValue': {'stringValue': '' if value is None or pd.isna(value) else str(value)}}
+
+def _update_cells_request(sheet_id, row_index, col_index, value):
+    '''Builds an updateCells request for a single cell (1-based row/col, like gspread).'''
+    return {'updateCells': {
+        'start': {'sheetId': sheet_id, 'rowIndex': row_index - 1, 'columnIndex': col_index - 1},
+        'rows': [{'values': [_to_cell_data(value)]}],
+        'fields': 'userEnteredValue',
+    }}
+
+def _append_cells_request(sheet_id, rows):
+    '''Builds an appendCells request that adds rows after the last row with data.'''
+    return {'appendCells': {
+        'sheetId': sheet_id,
+        'rows': [{'values': [_to_cell_data(v) for v in row]} for row in rows],
+        'fields': 'userEnteredValue',
+    }}
+
+def _build_price_library_requests(worksheet, library_values, parts_df):
     '''
-    Adds/updates part prices, increments usage count, and saves part descriptions.
+    Builds the requests that increment usage counts and add new parts to the Price Library.
+    Returns (requests, number_of_new_parts). Nothing is written here.
     '''
-    client = connect_to_google_sheet()
-    if not client:
-        return False
-    try:
-        spreadsheet = client.open(GSHEET_NAME)
-        try:
-            worksheet = spreadsheet.worksheet(PRICE_LIBRARY_SHEET_NAME)
-            headers = worksheet.row_values(1)
-            if "Usage Count" not in headers:
-                worksheet.update_cell(1, len(headers) + 1, "Usage Count")
-                headers.append("Usage Count")
-
-            library_data = worksheet.get_all_records()
-            part_map = {
-                str(rec.get('No.')): {
-                    'row': i + 2,
-                    'count': int(rec.get('Usage Count') or 0),
-                } for i, rec in enumerate(library_data)
-            }
-            existing_part_numbers = set(part_map.keys())
-
-        except gspread.exceptions.WorksheetNotFound:
-            worksheet = spreadsheet.add_worksheet(title=PRICE_LIBRARY_SHEET_NAME, rows="1000", cols=4)
-            headers = ["No.", "Description", "Amount Including Tax", "Usage Count"]
-            worksheet.append_row(headers)
-            part_map = {}
-            existing_part_numbers = set()
-
-        updates = []
-        parts_in_estimate = parts_df['No.'].astype(str).tolist()
-        usage_col_index = headers.index("Usage Count") + 1
-
-        for part_no in parts_in_estimate:
-            if part_no in part_map:
-                row_index = part_map[part_no]['row']
-                new_count = part_map[part_no]['count'] + 1
-                part_map[part_no]['count'] = new_count
-                updates.append({
-                    'range': gspread.utils.rowcol_to_a1(row_index, usage_col_index),
-                    'values': [[new_count]],
-                })
-
-        if updates:
-            worksheet.batch_update(updates)
-
-        excluded_parts = ['BILLABLE FREIGHT', 'TECHNICIAN HQ']
-        new_parts_df = parts_df[
-            (~parts_df['No.'].astype(str).isin(existing_part_numbers)) &
-            (parts_df['Amount Including Tax'].notna()) &
-            (parts_df['Amount Including Tax'] > 0) &
-            (~parts_df['No.'].isin(excluded_parts))
-        ].copy()
-
-        if not new_parts_df.empty:
-            new_parts_df.loc[:, 'Usage Count'] = 1
-            new_rows = new_parts_df[['No.', 'Description', 'Amount Including Tax', 'Usage Count']].values.tolist()
-            worksheet.append_rows(new_rows, value_input_option='USER_ENTERED')
-            st.info(f"Added {len(new_rows)} new part(s) to the Price Library.")
-
-        return True
-    except Exception as e:
-        st.error(f"Failed to update Price Library & Usage Count: {e}")
-        return False
+    requests = []
+    if library_values:
+        headers = library_values[0]
+        if "Usage Count" not in headers:
+            requests.append(_update_cells_request(worksheet.id, 1, len(headers) + 1, "Usage Count"))
+            headers = headers + ["Usage Count"]
+    else:
+        headers = ["No.", "Description", "Amount Including Tax", "Usage Count"]
+        requests.append(_append_cells_request(worksheet.id, [headers]))
+
+    part_idx = headers.index("No.") if "No." in headers else 0
+    usage_idx = headers.index("Usage Count")
+    part_map = {}
+    for i, row in enumerate(library_values[1:]):
+        count = row[usage_idx] if len(row) > usage_idx else ""
+        part_map[str(row[part_idx]) if len(row) > part_idx else ""] = {
+            'row': i + 2,
+            'count': int(float(count or 0)),
+        }
+    existing_part_numbers = set(part_map.keys())
+
+    for part_no in parts_df['No.'].astype(str).tolist():
+        if part_no in part_map:
+            part_map[part_no]['count'] += 1
+    for part_no in set(parts_df['No.'].astype(str)) & existing_part_numbers:
+        requests.append(_update_cells_request(worksheet.id, part_map[part_no]['row'], usage_idx + 1, part_map[part_no]['count']))
+
+    excluded_parts = ['BILLABLE FREIGHT', 'TECHNICIAN HQ']
+    new_parts_df = parts_df[
+        (~parts_df['No.'].astype(str).isin(existing_part_numbers)) &
+        (parts_df['Amount Including Tax'].notna()) &
+        (parts_df['Amount Including Tax'] > 0) &
+        (~parts_df['No.'].isin(excluded_parts))
+    ].copy()
+
+    if not new_parts_df.empty:
+        new_parts_df.loc[:, 'Usage Count'] = 1
+        new_rows = new_parts_df[['No.', 'Description', 'Amount Including Tax', 'Usage Count']].values.tolist()
+        requests.append(_append_cells_request(worksheet.id, new_rows))
+        return requests, len(new_rows)
+
+    return requests, 0
 
 # =============================================================================
 # ACTION LOGIC (UPDATE GOOGLE SHEET)
 # =============================================================================
-def _add_or_update_estimate_in_sheet(worksheet, headers, form_data, parts_df):
+def _build_estimate_log_requests(worksheet, headers, form_data, parts_df):
+    '''Builds the requests that log an estimate row to the estimate sheet. Nothing is written here.'''
     rma = form_data.get('rma')
     sn = form_data.get('serial')
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -238,19 +329,55 @@ def _add_or_update_estimate_in_sheet(worksheet, headers, form_data, parts_df):
 
     parts_json = parts_df.to_json(orient='records')
 
+    requests = []
     if "Parts JSON" not in headers:
-        worksheet.update_cell(1, len(headers) + 1, "Parts JSON")
+        requests.append(_update_cells_request(worksheet.id, 1, len(headers) + 1, "Parts JSON"))
 
     row_data = [
         rma, sn, form_data.get('contact'), form_data.get('cust_name'),
         form_data.get('cust_num'), timestamp, total_sum,
         form_data.get('description'), form_data.get('evaluation'), parts_json
     ]
-    worksheet.append_row(row_data)
-    return True
+    requests.append(_append_cells_request(worksheet.id, [row_data]))
+    return requests
 
-def add_or_update_estimate_in_gsheet(form_data, parts_df):
-    return gsheet_update_wrapper(_add_or_update_estimate_in_sheet, ESTIMATE_SHEET_NAME, form_data, parts_df)
+def batch_submit_estimate(form_data, parts_df, parts_df_for_library):
+    '''
+    Logs the estimate and updates the Price Library & usage counts in a single
+    Sheets API batchUpdate, so a generation costs one write round trip.
+    '''
+    import gspread
+    client = connect_to_google_sheet()
+    if not client:
+        return False
+    try:
+        spreadsheet = client.open(GSHEET_NAME)
+        worksheets = {ws.title: ws for ws in spreadsheet.worksheets()}
+        estimate_ws = worksheets.get(ESTIMATE_SHEET_NAME)
+        if estimate_ws is None:
+            st.error(f"Worksheet '{ESTIMATE_SHEET_NAME}' not found.")
+            return False
+        library_ws = worksheets.get(PRICE_LIBRARY_SHEET_NAME)
+        if library_ws is None:
+            library_ws = spreadsheet.add_worksheet(title=PRICE_LIBRARY_SHEET_NAME, rows="1000", cols=4)
+
+        value_ranges = spreadsheet.values_batch_get([
+            gspread.utils.absolute_range_name(ESTIMATE_SHEET_NAME, '1:1'),
+            gspread.utils.absolute_range_name(PRICE_LIBRARY_SHEET_NAME),
+        ]).get('valueRanges', [])
+        estimate_headers = (value_ranges[0].get('values') or [[]])[0]
+        library_values = value_ranges[1].get('values', [])
+
+        requests = _build_estimate_log_requests(estimate_ws, estimate_headers, form_data, parts_df)
+        library_requests, new_part_count = _build_price_library_requests(library_ws, library_values, parts_df_for_library)
+        spreadsheet.batch_update({'requests': requests + library_requests})
+
+        if new_part_count:
+            st.info(f"Added {new_part_count} new part(s) to the Price Library.")
+        return True
+    except Exception as e:
+        st.error(f"Failed to log estimate & update Price Library: {e}")
+        return False
 
 def _update_estimate_sent_in_sheet(worksheet, headers, rma, sn, email, sent_date):
     row = find_row_in_gsheet(worksheet, rma, sn, headers)
@@ -336,6 +463,7 @@ def generate_estimate_files(form_data, parts_df, save_directory):
         data_to_fill["final_total"] = f"${total_cost:.2f}"
 
         # --- 2. Open the PDF and fill the fields ---
+        import fitz # PyMuPDF, imported here so pages that never build a PDF don't pay for it
         doc = fitz.open(template_path)
         
         for page in doc:
@@ -372,6 +500,8 @@ def send_estimate_email(recipient_email, rma_number, serial_number, estimate_pdf
     Generates a custom credit card form and sends it along with the estimate PDF
     using the Resend API. Attachments are correctly encoded to Base64.
     """
+    import fitz # PyMuPDF for editing the credit card form
+    import resend
     try:
         # --- PART 1: GENERATE THE CUSTOM CREDIT CARD PDF (Your original logic) ---
         cc_form_template_path = 'creditform/Credit_card_form2.pdf'
@@ -446,13 +576,24 @@ def search_estimates_in_sheet(query, df):
     if df.empty or query == "": return pd.DataFrame()
     return df[df['RMA'].str.contains(query, case=False, na=False) | df['S/N'].str.contains(query, case=False, na=False)]
 
+def build_bc_links(rmas, page_id=BC_PAGE_ID, field_name=BC_RMA_FIELD_NAME):
+    """Builds Business Central links for a Series of RMAs in one pass; blank or 'N/A' RMAs get None."""
+    prefix = f"{BC_BASE_URL}?company={BC_COMPANY}&page={page_id}&filter='{urllib.parse.quote_plus(field_name)}'%20IS%20%27"
+    rma_str = rmas.astype(str)
+    stripped = rma_str.str.strip()
+    valid = rmas.notna() & stripped.ne('') & stripped.ne('N/A')
+    links = pd.Series(None, index=rmas.index, dtype=object)
+    links[valid] = prefix + rma_str[valid].map(urllib.parse.quote_plus) + "%27"
+    # The masked assignment leaves NaN in the skipped rows, so fill those with None explicitly
+    return links.where(valid, None)
+
 def identify_overdue_estimates(df, days_threshold=3):
     if df.empty: return pd.DataFrame()
     now = datetime.datetime.now()
     overdue_df = df[(df['Estimate Complete'].str.lower() == 'yes') & (df['Estimate Sent To Email'].str.lower() == 'n/a') & (df['Shipped'].str.lower().isin(['no', 'n/a'])) & (df['Estimate Complete Time'].notna()) & ((now - df['Estimate Complete Time']).dt.days > days_threshold)].copy()
     if not overdue_df.empty:
         overdue_df['Days Overdue for Sending'] = (now - overdue_df['Estimate Complete Time']).dt.days
-        overdue_df[BC_LINK_COL_NAME] = overdue_df.apply(lambda r: f"{BC_BASE_URL}?company={BC_COMPANY}&page={BC_PAGE_ID}&filter='{urllib.parse.quote_plus(BC_RMA_FIELD_NAME)}'%20IS%20%27{urllib.parse.quote_plus(str(r['RMA']))}%27", axis=1)
+        overdue_df[BC_LINK_COL_NAME] = build_bc_links(overdue_df['RMA'])
     return overdue_df
 
 def identify_overdue_reminders(df, days_threshold=2):
@@ -461,7 +602,7 @@ def identify_overdue_reminders(df, days_threshold=2):
     overdue_df = df[(df['Estimate Sent To Email'].str.lower() != 'n/a') & (df['Reminder Completed'].str.lower().isin(['no', 'n/a'])) & (df['Estimate Approved'].str.lower().isin(['no', 'n/a'])) & (df['Estimate Sent Time'].notna()) & ((now - df['Estimate Sent Time']).dt.days > days_threshold)].copy()
     if not overdue_df.empty:
         overdue_df['Days Pending Reminder'] = (now - overdue_df['Estimate Sent Time']).dt.days
-        overdue_df[BC_LINK_COL_NAME] = overdue_df.apply(lambda r: f"{BC_BASE_URL}?company={BC_COMPANY}&page={BC_PAGE_ID}&filter='{urllib.parse.quote_plus(BC_RMA_FIELD_NAME)}'%20IS%20%27{urllib.parse.quote_plus(str(r['RMA']))}%27", axis=1)
+        overdue_df[BC_LINK_COL_NAME] = build_bc_links(overdue_df['RMA'])
     return overdue_df
 
 def identify_overdue_for_shipping(df, days_threshold=1):
@@ -470,7 +611,7 @@ def identify_overdue_for_shipping(df, days_threshold=1):
     overdue_df = df[(df['Estimate Approved'].str.lower() == 'yes') & (df['QA Approved'].str.lower() == 'yes') & (df['Shipped'].str.lower().isin(['no', 'n/a'])) & (df['QA Approved Time'].notna()) & ((now - df['QA Approved Time']).dt.days > days_threshold)].copy()
     if not overdue_df.empty:
         overdue_df['Days Pending Shipping'] = (now - overdue_df['QA Approved Time']).dt.days
-        overdue_df[BC_LINK_COL_NAME] = overdue_df.apply(lambda r: f"{BC_BASE_URL}?company={BC_COMPANY}&page={BC_PAGE_ID}&filter='{urllib.parse.quote_plus(BC_RMA_FIELD_NAME)}'%20IS%20%27{urllib.parse.quote_plus(str(r['RMA']))}%27", axis=1)
+        overdue_df[BC_LINK_COL_NAME] = build_bc_links(overdue_df['RMA'])
     return overdue_df
 
 def generate_single_day_report_content(df, report_date_obj):
@@ -489,6 +630,7 @@ def generate_single_day_report_content(df, report_date_obj):
     return report_content
 
 def get_archived_reports(archive_sheet_name):
+    import gspread
     client = connect_to_google_sheet()
     if not client: return []
     try:
@@ -510,6 +652,7 @@ def get_last_report_date_from_archive(archived_reports):
     except: return date.today() - timedelta(days=1)
 
 def save_report_to_archive(report_data, archive_sheet_name, archive_headers):
+    import gspread
     client = connect_to_google_sheet()
     if not client: return False
     try:
@@ -531,6 +674,36 @@ def save_report_to_archive(report_data, archive_sheet_name, archive_headers):
         st.error(f"Error saving report to archive '{archive_sheet_name}': {e}")
         return False
 
+def write_report_sheet(writer, df, sheet_name, header_format):
+    """Writes df to an xlsxwriter sheet with formatted headers and columns sized to their longest value."""
+    df.to_excel(writer, sheet_name=sheet_name, index=False)
+    worksheet = writer.sheets[sheet_name]
+    widths = {}
+    if not df.empty:
+        # One str.len pass per column, computed before any cells are formatted. On pandas 3
+        # astype(str) keeps missing values missing, so an all-NA column measures as NaN
+        lengths = df.astype(str).apply(lambda col: col.str.len().max()).fillna(0)
+        widths = {col: max(int(lengths[col]), len(str(col))) + 2 for col in df.columns}
+    for col_num, value in enumerate(df.columns.values):
+        worksheet.write(0, col_num, value, header_format)
+        if value in widths:
+            worksheet.set_column(col_num, col_num, widths[value])
+    return worksheet
+
+@st.cache_data(ttl=300)
+def create_parquet_report_bytes(sheets):
+    """
+    Writes report sheets ({sheet name: df}) as a single zstd-compressed Parquet file, with a
+    'Report' column naming each row's sheet. Much faster than xlsxwriter on large reports.
+    """
+    combined = pd.concat([df.assign(Report=name) for name, df in sheets.items()], ignore_index=True)
+    # Arrow needs one type per column; text columns from Sheets can mix numbers and strings
+    text_cols = combined.select_dtypes(include='object').columns
+    combined[text_cols] = combined[text_cols].astype('string')
+    output = BytesIO()
+    combined.to_parquet(output, engine='pyarrow', compression='zstd', compression_level=3, index=False)
+    return output.getvalue()
+
 def create_excel_report_bytes(report_data, report_type="Daily"):
     output = BytesIO()
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
@@ -570,6 +743,7 @@ def create_excel_report_bytes(report_data, report_type="Daily"):
 
 def load_price_library_df():
     '''Loads the entire price library from Google Sheets into a DataFrame for display and editing.'''
+    import gspread
     client = connect_to_google_sheet()
     if not client:
         return pd.DataFrame()
@@ -763,6 +937,7 @@ def process_historical_usage(master_df):
 @st.cache_data(ttl=600)
 def load_customer_list():
     """Loads the customer list from Google Sheets into a dictionary."""
+    import gspread
     CUSTOMER_LIST_SHEET_NAME = "Customer List"
     client = connect_to_google_sheet()
     if not client:
@@ -787,6 +962,7 @@ def load_customer_list():
 @st.cache_data(ttl=1800)
 def load_zone_ranges():
     """Loads the ZIP code ranges and corresponding zones from Google Sheets."""
+    import gspread
     client = connect_to_google_sheet()
     if not client: return pd.DataFrame()
     try:
@@ -811,6 +987,7 @@ def load_zone_ranges():
 @st.cache_data(ttl=1800)
 def load_shipping_prices():
     """Loads the shipping prices and sets the Zone as the index."""
+    import gspread
     client = connect_to_google_sheet()
     if not client: return pd.DataFrame()
     try:
@@ -833,55 +1010,207 @@ def load_shipping_prices():
         st.error(f"Error loading Shipping Prices: {e}")
         return pd.DataFrame()
 
-def update_ticket_status(sheet, ticket_id, new_status):
+@st.cache_data(ttl=1800)
+def load_shipping_tables():
     """
-    Finds a ticket by its ID in the Google Sheet and updates its status.
+    Preconverts the shipping zones and prices into lookup-friendly structures:
+    sorted NumPy arrays for the ZIP ranges and a {(zone, item_type): price} dict.
+    Returns None if either sheet is unavailable.
+    """
+    zone_ranges_df = load_zone_ranges()
+    shipping_prices_df = load_shipping_prices()
+    if zone_ranges_df.empty or shipping_prices_df.empty:
+        return None
+
+    order = zone_ranges_df['Start ZIP'].to_numpy().argsort(kind='stable')
+    prices = {}
+    for item_type in shipping_prices_df.columns:
+        for zone, price in pd.to_numeric(shipping_prices_df[item_type], errors='coerce').dropna().items():
+            prices[(str(zone), item_type)] = float(price)
+
+    return SimpleNamespace(
+        starts=zone_ranges_df['Start ZIP'].to_numpy()[order],
+        ends=zone_ranges_df['End ZIP'].to_numpy()[order],
+        zones=zone_ranges_df['Zone'].to_numpy()[order],
+        prices=prices,
+    )
+
+def find_shipping_zone(shipping_tables, zip_prefix):
+    """Returns the zone whose ZIP range contains zip_prefix, or None."""
+    idx = np.searchsorted(shipping_tables.starts, zip_prefix, side='right') - 1
+    if idx >= 0 and zip_prefix <= shipping_tables.ends[idx]:
+        return shipping_tables.zones[idx]
+    return None
+
+# =============================================================================
+# TICKET SYSTEM
+# =============================================================================
+@st.cache_resource(ttl=300)
+def connect_to_tickets_sheet():
     """
+    Returns the 'Tickets' worksheet through the shared, cached Sheets client. On failure it
+    returns None without raising, so the failure is cached for the ttl like a success.
+    """
+    client = connect_to_google_sheet()
+    if client is None:
+        return None
     try:
-        cell = sheet.find(ticket_id)
-        if not cell:
-            return False, f"Could not find ticket {ticket_id} in the sheet."
-        
-        row_index = cell.row
-        status_col_index = sheet.find("Status").col
-        
-        sheet.update_cell(row_index, status_col_index, new_status)
-        
-        return True, f"Ticket {ticket_id} status updated to {new_status}."
+        return client.open(GSHEET_NAME).worksheet(TICKETS_SHEET_NAME)
+    except Exception as e:
+        st.error(f"Could not connect to Google Sheets: {e}")
+        return None
+
+@st.cache_data(ttl=900, show_spinner="Loading tickets…")  # Safety-net refresh; the Refresh button reloads on demand
+def load_tickets(_sheet):
+    """Loads all ticket records from the worksheet into a DataFrame."""
+    import gspread
+    if _sheet is None:
+        return pd.DataFrame()
+    headers = _sheet.row_values(1)
+    wanted = [col for col in TICKET_COLUMNS if col in headers]
+    if not wanted:
+        return pd.DataFrame()
+    # Fetch only the columns the page uses, skipping the ever-growing Notes log
+    letters = [re.sub(r'\d+$', '', gspread.utils.rowcol_to_a1(1, headers.index(col) + 1)) for col in wanted]
+    ranges = _sheet.batch_get([f"{letter}2:{letter}" for letter in letters], major_dimension='COLUMNS')
+    columns = [value_range[0] if value_range else [] for value_range in ranges]
+    # The API trims trailing blanks per column, so pad them to a common length
+    n_rows = max(len(values) for values in columns)
+    df = pd.DataFrame({col: values + [''] * (n_rows - len(values)) for col, values in zip(wanted, columns)})
+    # Arrow-backed text: compact buffers, faster str.contains/== and cheaper Arrow hand-off to st.dataframe
+    for col in ("Ticket ID", "Customer Email", "Subject"):
+        if col in df.columns and pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].astype("string[pyarrow]")
+    # Index by Ticket ID (column kept) so the reply section can look a ticket up by hash
+    if "Ticket ID" in df.columns:
+        df.index = pd.Index(df["Ticket ID"].to_numpy())
+    # Few distinct statuses: int codes make the status filter and option list cheap
+    if "Status" in df.columns:
+        df["Status"] = df["Status"].astype("category")
+    # Lets the page tell which of its own session edits this load already contains
+    df.attrs['loaded_at'] = time.time()
+    return df
+
+@st.cache_data(ttl=60)
+def get_status_options(df_tickets):
+    """The status filter choices: 'All' followed by each distinct status, in sheet order."""
+    return ["All"] + pd.unique(df_tickets["Status"]).tolist()
+
+@st.cache_data(ttl=60)
+def filter_tickets(df_tickets, status_filter="All", keyword=""):
+    """
+    Returns the tickets with status_filter ("All" for every ticket) whose Subject or Body
+    contains keyword (case-insensitive, optional), and an ordered {Ticket ID: Subject} map
+    for the reply selectbox (first row wins for repeated IDs).
+    """
+    # Vectorised masks only; no row-wise apply
+    mask = np.ones(len(df_tickets), dtype=bool)
+    if status_filter != "All":
+        mask &= (df_tickets["Status"] == status_filter).to_numpy()
+    if keyword:
+        text_cols = [col for col in ("Subject", "Body") if col in df_tickets.columns]
+        hits = np.zeros(len(df_tickets), dtype=bool)
+        for col in text_cols:
+            hits |= df_tickets[col].str.contains(keyword, case=False, regex=False, na=False).to_numpy()
+        mask &= hits
+    df_filtered = df_tickets if mask.all() else df_tickets[mask]
+    ticket_ids = df_filtered['Ticket ID'].astype(str)
+    first = ~ticket_ids.duplicated()
+    ticket_subjects = dict(zip(ticket_ids[first], df_filtered['Subject'].astype(str)[first]))
+    return df_filtered, ticket_subjects
+
+@st.cache_data(ttl=60, max_entries=10)
+def ticket_details(df_tickets):
+    """{Ticket ID: {field: value}} for the reply section, built once per load (first row wins for repeated IDs)."""
+    first = df_tickets[~df_tickets.index.duplicated()]
+    return first[["Ticket ID", "Customer Email", "Subject", "Body"]].to_dict("index")
+
+def update_ticket_statuses(sheet, status_updates):
+    """
+    Sets the status of several tickets at once. status_updates is a list of
+    (ticket_id, new_status) tuples; one read locates the rows and one batch_update writes them.
+    """
+    import gspread
+    try:
+        all_values = sheet.get_all_values()
+        headers = all_values[0] if all_values else []
+        if "Status" not in headers:
+            return False, "The 'Tickets' sheet is missing a 'Status' column."
+        status_col_index = headers.index("Status") + 1
+
+        updates = []
+        for ticket_id, new_status in status_updates:
+            row_index = _find_ticket_row(all_values, ticket_id)
+            if row_index is None:
+                return False, f"Could not find ticket {ticket_id} in the sheet."
+            updates.append({'range': gspread.utils.rowcol_to_a1(row_index, status_col_index), 'values': [[new_status]]})
+
+        sheet.batch_update(updates, value_input_option='USER_ENTERED')
+
+        if len(status_updates) == 1:
+            ticket_id, new_status = status_updates[0]
+            return True, f"Ticket {ticket_id} status updated to {new_status}."
+        return True, f"Updated the status of {len(status_updates)} tickets."
 
     except Exception as e:
         return False, f"An error occurred while updating the sheet: {e}"
 
+def update_ticket_status(sheet, ticket_id, new_status):
+    """
+    Finds a ticket by its ID in the Google Sheet and updates its status.
+    """
+    return update_ticket_statuses(sheet, [(ticket_id, new_status)])
+
+
+def _find_ticket_row(all_values, ticket_id):
+    """Returns the 1-based sheet row of ticket_id from a get_all_values() grid, or None."""
+    headers = all_values[0] if all_values else []
+    if "Ticket ID" not in headers:
+        return None
+    id_col = headers.index("Ticket ID")
+    for i, row in enumerate(all_values[1:], start=2):
+        if len(row) > id_col and row[id_col] == str(ticket_id):
+            return i
+    return None
 
 def send_ticket_reply_and_log(sheet, ticket_id, customer_email, original_subject, reply_body, team_member_name):
     """
     Sends an email reply, logs it, and saves the RMA if found in the reply.
     """
+    import gspread
+    import resend
     try:
         # (The email sending part remains the same)
         resend.api_key = st.secrets["resend"]["api_key"]
-        full_reply_html = f"<p>{reply_body.replace('\\n', '<br>')}</p><br><p>--- Original Message ---</p><blockquote>{original_subject}</blockquote>"
+        reply_html = reply_body.replace('\\n', '<br>')
+        full_reply_html = f"<p>{reply_html}</p><br><p>--- Original Message ---</p><blockquote>{original_subject}</blockquote>"
         params = { "from": f"{team_member_name} <onboarding@resend.dev>", "to": [customer_email], "subject": f"Re: {original_subject}", "html": full_reply_html }
         email = resend.Emails.send(params)
 
-        # (The logging part remains the same)
-        cell = sheet.find(ticket_id)
-        if not cell: return False, f"Could not find ticket {ticket_id}..."
-        row_index = cell.row
+        # --- LOGGING: one read for headers/row/notes, one batched write ---
+        all_values = sheet.get_all_values()
+        headers = all_values[0] if all_values else []
+        col_index = {name: i + 1 for i, name in enumerate(headers)}
+        row_index = _find_ticket_row(all_values, ticket_id)
+        if row_index is None: return False, f"Could not find ticket {ticket_id}..."
+        row_values = all_values[row_index - 1]
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         note = f"--- Reply Sent by {team_member_name} at {timestamp} ---\\n{reply_body}\\n\\n"
-        notes_col_index = sheet.find("Notes").col
-        existing_notes = sheet.cell(row_index, notes_col_index).value or ""
-        sheet.update_cell(row_index, notes_col_index, note + existing_notes)
-        sheet.update_cell(row_index, sheet.find("Status").col, "In Progress")
+        notes_col_index = col_index["Notes"]
+        existing_notes = row_values[notes_col_index - 1] if len(row_values) >= notes_col_index else ""
+        updates = [
+            {'range': gspread.utils.rowcol_to_a1(row_index, notes_col_index), 'values': [[note + existing_notes]]},
+            {'range': gspread.utils.rowcol_to_a1(row_index, col_index["Status"]), 'values': [["In Progress"]]},
+        ]
 
         # --- SIMPLIFIED RMA LOGIC ---
-        rma_match = re.search(r'(RMA\d+)', reply_body, re.IGNORECASE)
+        rma_match = RMA_REGEX.search(reply_body)
         if rma_match:
             rma_number = rma_match.group(1)
-            rma_col_index = sheet.find("RMA").col
             # We only save the RMA number now, not the link.
-            sheet.update_cell(row_index, rma_col_index, rma_number)
+            updates.append({'range': gspread.utils.rowcol_to_a1(row_index, col_index["RMA"]), 'values': [[rma_number]]})
+
+        sheet.batch_update(updates, value_input_option='USER_ENTERED')
 
         return True, "Successfully sent reply and updated ticket log."
 
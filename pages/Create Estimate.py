@@ -3,23 +3,24 @@
 import streamlit as st
 import pandas as pd
 import os
+import hashlib
+import pickle
 from datetime import date
 from io import BytesIO
 import streamlit_shadcn_ui as sui
 from logic import (
     generate_estimate_files,
-    add_or_update_estimate_in_gsheet,
+    batch_submit_estimate,
     send_estimate_email,
     update_estimate_sent_details_in_gsheet,
     load_price_library,
-    update_price_library_and_usage_count,
     load_price_library_df,
     save_price_library_df,
     load_estimate_for_revision,
     get_revision_rma,
     load_customer_list,
-    load_zone_ranges,
-    load_shipping_prices,
+    load_shipping_tables,
+    find_shipping_zone,
     SOURCE_PARTS_ARCHIVE_DIR
 )
 
@@ -36,6 +37,7 @@ st.title("📝 Create a New Customer Estimate")
 
 # --- Define a directory to save generated files ---
 SAVE_DIRECTORY = "generated_estimates"
+PARTS_EDITOR_PAGE_SIZE = 200 # Larger parts sheets are edited one page at a time
 if not os.path.exists(SAVE_DIRECTORY):
     os.makedirs(SAVE_DIRECTORY)
 
@@ -60,7 +62,9 @@ def clear_form_state():
         'shipping_cost',
         'revision_data',
         'search_rma_input',
-        'uploaded_file'
+        'uploaded_file',
+        'parts_page_edits',
+        'parts_page_edits_source'
     ]
     for key in keys_to_clear:
         if key in st.session_state:
@@ -107,8 +111,9 @@ def populate_form_for_revision():
     '''Populates the form with data from a loaded estimate.'''
     data = st.session_state.get('revision_data')
     if data:
-        # Using the exact keys from your debug output and wrapping every
-        # line with str() to prevent data type errors.
+        # Sheet headers can carry stray whitespace/carriage returns, so clean the keys once up front
+        data = {k.strip().rstrip('\r') if isinstance(k, str) else k: v for k, v in data.items()}
+        # Wrapping every line with str() to prevent data type errors.
         st.session_state['rma'] = get_revision_rma(str(data.get('RMA', '')))
         st.session_state['cust_name'] = str(data.get('Cust Name', ''))
         st.session_state['cust_num'] = str(data.get('Cust Num', ''))
@@ -116,12 +121,15 @@ def populate_form_for_revision():
         st.session_state['contact'] = str(data.get('Contact', ''))
         st.session_state['description'] = str(data.get('Customer Description of Problem', ''))
         
-        # This is the corrected key including the invisible carriage return character
-        st.session_state['evaluation'] = str(data.get('Technician Product Evaluate:\r', ''))
+        st.session_state['evaluation'] = str(data.get('Technician Product Evaluate:', ''))
         
         # Handle based on record type
         if not data.get('is_legacy', True):
-            st.session_state['parts_df'] = data.get('parts_df')
+            parts_df = data.get('parts_df')
+            parts_df.columns = parts_df.columns.astype(str).str.strip().str.rstrip('\r')
+            st.session_state['parts_df'] = parts_df
+            # A freshly loaded estimate starts without page edits, even when it's the same RMA again
+            st.session_state.pop('parts_page_edits_source', None)
             st.session_state.uploader_key = st.session_state.get('uploader_key', 0) + 1
             if 'file_uploader' in st.session_state:
                 del st.session_state['file_uploader']
@@ -138,6 +146,64 @@ def autofill_customer_name():
     if cust_num in customer_list:
         st.session_state['cust_name'] = customer_list[cust_num]
 
+@st.cache_data(ttl=600, max_entries=20, show_spinner=False)
+def read_parts_file(file_bytes):
+    '''Parses an uploaded parts workbook; cached on its bytes so reruns skip the xlsx parse.'''
+    return pd.read_excel(BytesIO(file_bytes))
+
+@st.cache_data(ttl=600, max_entries=20, show_spinner=False)
+def preview_parts(shipping_cost, lib_hash, _price_library, parts_df):
+    '''
+    Applies the freight, price-library and TECHNICIAN HQ overrides to a parts list.
+    Cached on the parts, shipping cost and library hash, so reruns that change none of
+    them skip the pandas work. Returns the DataFrame and the notices to show the user.
+    '''
+    notices = []
+    # This ensures the column is always a float type, ready for decimals.
+    parts_df['Amount Including Tax'] = parts_df['Amount Including Tax'].astype(float)
+
+    if shipping_cost > 0:
+        freight_mask = parts_df['No.'] == 'BILLABLE FREIGHT'
+        if freight_mask.any():
+            parts_df.loc[freight_mask, 'Amount Including Tax'] = shipping_cost
+            notices.append(("toast", f"Automatically set BILLABLE FREIGHT cost to ${shipping_cost:,.2f}", "🚚"))
+
+    if _price_library:
+        autofill_count = 0
+        correction_count = 0
+        for index, row in parts_df.iterrows():
+            part_no = str(row['No.'])
+            if part_no in _price_library and _price_library[part_no] is not None:
+                library_price = float(_price_library[part_no])
+
+                if pd.isna(row['Amount Including Tax']) or row['Amount Including Tax'] == 0:
+                    parts_df.at[index, 'Amount Including Tax'] = library_price
+                    autofill_count += 1
+                else:
+                    uploaded_price = float(row['Amount Including Tax'])
+                    if uploaded_price > library_price:
+                        parts_df.at[index, 'Amount Including Tax'] = library_price
+                        correction_count += 1
+                        notices.append(("toast", f"Price for {part_no} corrected to ${library_price:,.2f}", "✅"))
+
+        if autofill_count > 0:
+            notices.append(("toast", f"Auto-filled {autofill_count} price(s) from the library.", "✨"))
+        if correction_count > 0:
+            notices.append(("info", f"Applied {correction_count} price correction(s) to match the library.", "🛡️"))
+
+    technician_hq_mask = parts_df['No.'] == 'TECHNICIAN HQ'
+    if technician_hq_mask.any():
+        parts_df.loc[technician_hq_mask, 'Amount Including Tax'] = 285
+
+    return parts_df, notices
+
+@st.cache_data
+def load_demo_parts():
+    '''Loads the fixed demo parts list once; callers get a copy so overrides don't touch the cache.'''
+    demo_df = pd.read_excel('demo_parts.xlsx')
+    demo_df['Amount Including Tax'] = demo_df['Amount Including Tax'].astype(float)
+    return demo_df
+
 def run_live_demo():
     """Controls the step-by-step execution of the live demo."""
     step = st.session_state.get('demo_step', 0)
@@ -180,9 +246,7 @@ def run_live_demo():
 
     elif step == 3 and 'parts_df' not in st.session_state:
         try:
-            mock_file_path = 'demo_parts.xlsx'
-            demo_df = pd.read_excel(mock_file_path)
-            demo_df['Amount Including Tax'] = demo_df['Amount Including Tax'].astype(float)
+            demo_df = load_demo_parts()
             
             if 'shipping_cost' in st.session_state and st.session_state.shipping_cost > 0:
                 freight_mask = demo_df['No.'] == 'BILLABLE FREIGHT'
@@ -306,9 +370,8 @@ evaluation = st.text_area("Technician Product Evaluation", value=st.session_stat
 
 st.subheader("Shipping Cost Calculator")
 
-# Load shipping data once
-zone_ranges_df = load_zone_ranges() # <-- Updated function call
-shipping_prices_df = load_shipping_prices()
+# Load shipping data once (preconverted to arrays and a price lookup)
+shipping_tables = load_shipping_tables()
 
 ship_col1, ship_col2, ship_col3 = st.columns([1, 1, 2])
 
@@ -327,24 +390,20 @@ with ship_col2:
     )
 
 # --- New Calculation Logic for Ranges ---
-if shipping_zip and item_type and not zone_ranges_df.empty and not shipping_prices_df.empty:
+if shipping_zip and item_type and shipping_tables is not None:
     if len(shipping_zip) >= 3 and shipping_zip.isdigit():
         zip_prefix_int = int(shipping_zip[:3])
-        found_zone = None
 
         # Find which range the ZIP prefix falls into
-        for _, row in zone_ranges_df.iterrows():
-            if row['Start ZIP'] <= zip_prefix_int <= row['End ZIP']:
-                found_zone = row['Zone']
-                break # Found the correct range, stop searching
+        found_zone = find_shipping_zone(shipping_tables, zip_prefix_int)
         
-        if found_zone:
+        if found_zone is not None:
             try:
-                price = shipping_prices_df.loc[str(found_zone), item_type]
-                st.session_state['shipping_cost'] = float(price)
+                price = shipping_tables.prices[(str(found_zone), item_type)]
+                st.session_state['shipping_cost'] = price
                 with ship_col3:
-                    st.metric("Calculated Shipping Cost", f"${float(price):,.2f}")
-            except (KeyError, ValueError):
+                    st.metric("Calculated Shipping Cost", f"${price:,.2f}")
+            except KeyError:
                 st.session_state['shipping_cost'] = 0
                 with ship_col3:
                     st.warning(f"No price found for Zone {found_zone} and item '{item_type}'.")
@@ -378,46 +437,20 @@ if uploaded_file is not None or 'parts_df' in st.session_state:
             # Store the bytes in session state for archiving later
             st.session_state['uploaded_file_bytes'] = uploaded_file.getvalue() 
             # Read from the stored bytes to create the DataFrame
-            full_parts_df = pd.read_excel(BytesIO(st.session_state['uploaded_file_bytes']))
+            full_parts_df = read_parts_file(st.session_state['uploaded_file_bytes'])
+            parts_source = hashlib.blake2b(st.session_state['uploaded_file_bytes'], digest_size=8).hexdigest()
         else:
             full_parts_df = st.session_state['parts_df']
-
-        # This ensures the column is always a float type, ready for decimals.
-        full_parts_df['Amount Including Tax'] = full_parts_df['Amount Including Tax'].astype(float)
-        
-        if 'shipping_cost' in st.session_state and st.session_state['shipping_cost'] > 0:
-            freight_mask = full_parts_df['No.'] == 'BILLABLE FREIGHT'
-            if freight_mask.any():
-                full_parts_df.loc[freight_mask, 'Amount Including Tax'] = st.session_state['shipping_cost']
-                st.toast(f"Automatically set BILLABLE FREIGHT cost to ${st.session_state['shipping_cost']:,.2f}", icon="🚚")
+            revision = st.session_state.get('revision_data') or {}
+            parts_source = f"revision_{revision.get('RMA', '')}"
 
         price_library = load_price_library()
-        if price_library:
-            autofill_count = 0
-            correction_count = 0
-            for index, row in full_parts_df.iterrows():
-                part_no = str(row['No.'])
-                if part_no in price_library and price_library[part_no] is not None:
-                    library_price = float(price_library[part_no])
-                    
-                    if pd.isna(row['Amount Including Tax']) or row['Amount Including Tax'] == 0:
-                        full_parts_df.at[index, 'Amount Including Tax'] = library_price
-                        autofill_count += 1
-                    else:
-                        uploaded_price = float(row['Amount Including Tax'])
-                        if uploaded_price > library_price:
-                            full_parts_df.at[index, 'Amount Including Tax'] = library_price
-                            correction_count += 1
-                            st.toast(f"Price for {part_no} corrected to ${library_price:,.2f}", icon="✅")
-            
-            if autofill_count > 0:
-                st.toast(f"Auto-filled {autofill_count} price(s) from the library.", icon="✨")
-            if correction_count > 0:
-                st.info(f"Applied {correction_count} price correction(s) to match the library.", icon="🛡️")
-
-        technician_hq_mask = full_parts_df['No.'] == 'TECHNICIAN HQ'
-        if technician_hq_mask.any():
-            full_parts_df.loc[technician_hq_mask, 'Amount Including Tax'] = 285
+        lib_hash = hashlib.blake2b(pickle.dumps(sorted(price_library.items())), digest_size=8).hexdigest()
+        full_parts_df, notices = preview_parts(
+            st.session_state.get('shipping_cost', 0), lib_hash, price_library, full_parts_df
+        )
+        for notice_type, message, icon in notices:
+            getattr(st, notice_type)(message, icon=icon)
 
         if 'Amount Including Tax' not in full_parts_df.columns:
             st.error("The uploaded file is missing the 'Amount Including Tax' column.")
@@ -430,12 +463,36 @@ if uploaded_file is not None or 'parts_df' in st.session_state:
         full_parts_df['Quantity'] = pd.to_numeric(full_parts_df['Quantity'], errors='coerce').fillna(1)
 
         columns_to_display = ["No.", "Description", "Quantity", "Amount Including Tax"]
-        display_df = full_parts_df[columns_to_display]
 
         st.info("Edit the unit prices in the 'Amount Including Tax' column. The total cost will update automatically.")
 
+        # Only send one page of a large parts sheet to the editor; the cells changed on any page are kept in session state
+        is_paginated = len(full_parts_df) > PARTS_EDITOR_PAGE_SIZE
+        if is_paginated:
+            page_count = -(-len(full_parts_df) // PARTS_EDITOR_PAGE_SIZE)
+            page = st.number_input(f"Parts page (1-{page_count})", min_value=1, max_value=page_count, value=1, step=1) - 1
+            # Stored edits belong to one parts list (an uploaded file, or the estimate loaded for revision)
+            if st.session_state.get('parts_page_edits_source') != parts_source:
+                st.session_state['parts_page_edits_source'] = parts_source
+                st.session_state['parts_page_edits'] = {}
+            page_edits = st.session_state['parts_page_edits']
+            # Re-apply every stored change ({row position: {column: value}}), this page's included:
+            # Streamlit drops the state of editors that weren't rendered, so a revisited page starts empty
+            for row_pos, changes in page_edits.items():
+                if row_pos >= len(full_parts_df):
+                    continue
+                for col, value in changes.items():
+                    if col in full_parts_df.columns:
+                        full_parts_df.iloc[row_pos, full_parts_df.columns.get_loc(col)] = value
+            editor_key = f"parts_editor_{parts_source}_page_{page}"
+        else:
+            page = 0
+            editor_key = "parts_editor"
+        window_start = page * PARTS_EDITOR_PAGE_SIZE
+        display_df = full_parts_df[columns_to_display]
+
         edited_display_df = st.data_editor(
-            display_df,
+            display_df.iloc[window_start:window_start + PARTS_EDITOR_PAGE_SIZE],
             num_rows="dynamic",
             column_config={
                 "Amount Including Tax": st.column_config.NumberColumn(
@@ -444,25 +501,31 @@ if uploaded_file is not None or 'parts_df' in st.session_state:
                     step=0.01,
                 )
             },
-            key="parts_editor"
+            key=editor_key
         )
 
+        if is_paginated:
+            # Merge this page's changed cells into the store instead of replacing its entry, so a
+            # revisited page's empty editor state doesn't wipe what was changed there before
+            for row_in_page, changes in st.session_state[editor_key].get('edited_rows', {}).items():
+                page_edits.setdefault(window_start + int(row_in_page), {}).update(changes)
+
         full_parts_df.set_index('No.', inplace=True)
         edited_display_df.set_index('No.', inplace=True)
         full_parts_df.update(edited_display_df)
         full_parts_df.reset_index(inplace=True)
 
-        st.session_state['parts_for_library'] = full_parts_df.copy()
+        # The library update only needs these columns, so snapshot just them before the totals overwrite prices
+        st.session_state['parts_for_library'] = full_parts_df[columns_to_display].copy()
 
         full_parts_df['Line Total'] = full_parts_df['Quantity'] * full_parts_df['Amount Including Tax']
 
         total_cost = full_parts_df['Line Total'].sum()
         st.metric("Total Estimated Cost", f"${total_cost:,.2f}")
 
-        final_estimate_df = full_parts_df.copy()
-        final_estimate_df['Amount Including Tax'] = final_estimate_df['Line Total']
+        full_parts_df['Amount Including Tax'] = full_parts_df['Line Total']
 
-        st.session_state['parts_df'] = final_estimate_df
+        st.session_state['parts_df'] = full_parts_df
 
     except Exception as e:
         st.error(f"Error reading or processing the Excel file: {e}")
@@ -486,8 +549,11 @@ if 'parts_df' in st.session_state:
                             os.makedirs(SOURCE_PARTS_ARCHIVE_DIR)
                         
                         archive_path = os.path.join(SOURCE_PARTS_ARCHIVE_DIR, f"{rma}.xlsx")
-                        with open(archive_path, "wb") as f:
+                        # Write to a temp file and swap it in so a failed write never leaves a half-written archive
+                        tmp_archive_path = archive_path + ".tmp"
+                        with open(tmp_archive_path, "wb", buffering=1 << 20) as f:
                             f.write(st.session_state['uploaded_file_bytes'])
+                        os.replace(tmp_archive_path, archive_path)
                         
                         # Clean up to prevent re-saving on refresh
                         del st.session_state['uploaded_file_bytes']
@@ -501,11 +567,9 @@ if 'parts_df' in st.session_state:
                         st.success("✅ Documents generated successfully!")
                         st.session_state['file_paths'] = file_paths
 
-                        with st.spinner("Updating 'Estimate Form MOAS' sheet..."):
-                            if add_or_update_estimate_in_gsheet(form_data, parts_df_for_generation):
+                        with st.spinner("Updating 'Estimate Form MOAS' sheet, Price Library and Usage Counts..."):
+                            if batch_submit_estimate(form_data, parts_df_for_generation, parts_df_for_library):
                                 st.success("✅ Estimate logged successfully.")
-                                with st.spinner("Updating Price Library and Usage Counts..."):
-                                    update_price_library_and_usage_count(parts_df_for_library)
                                 st.cache_data.clear()
                             else:
                                 st.error("❌ Failed to log estimate.")
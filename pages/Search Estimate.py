@@ -4,11 +4,6 @@ import streamlit as st
 import os
 import glob
 from datetime import date
-import pandas as pd
-import openpyxl # Import openpyxl to read specific cells
-
-# Import the necessary logic functions
-from logic import send_estimate_email, update_estimate_sent_details_in_gsheet
 
 # --- Page Configuration ---
 st.set_page_config(layout="wide")
@@ -70,6 +65,9 @@ if 'found_files' in st.session_state:
             # --- Section to display parts and price from Excel file ---
             if file_path.lower().endswith('.xlsx'):
                 with st.expander("View Parts & Price Details"):
+                    # Imported here so searches that only find PDFs never load openpyxl/pandas
+                    import openpyxl # Import openpyxl to read specific cells
+                    import pandas as pd
                     try:
                         # FIX: Use openpyxl to read specific cell ranges
                         workbook = openpyxl.load_workbook(file_path, data_only=True)
@@ -121,6 +119,8 @@ if 'found_files' in st.session_state:
 
                     recipient = st.text_input("Recipient Email Address", key=f"email_{file_name}")
                     if st.button("📧 Send Email", key=f"send_{file_name}"):
+                        # Import the necessary logic functions only when an email is actually sent
+                        from logic import send_estimate_email, update_estimate_sent_details_in_gsheet
                         if recipient and "@" in recipient:
                             with st.spinner("Sending email..."):
                                 email_success, _ = send_estimate_email(recipient, rma_from_filename, file_path)
@@ -1,10 +1,13 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, date, timedelta 
-import gspread 
-from oauth2client.service_account import ServiceAccountCredentials 
-import urllib.parse 
 from io import BytesIO
+from logic import connect_to_google_sheet, build_bc_links, write_report_sheet, create_parquet_report_bytes, fetch_matching_rows, parse_sheet_datetimes
+
+# Copy-on-Write (the default from pandas 3): filtered frames share data with data_df until a column is added
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -31,8 +34,6 @@ EXPECTED_COLUMN_ORDER = [
 ALL_STATUS_COLUMNS = ["Estimate Complete", "Estimate Approved", "Reminder Completed", "QA Approved", "Shipped"]
 ALL_TIME_COLUMNS = [col for col in EXPECTED_COLUMN_ORDER if "Time" in col]
 
-BC_BASE_URL = "https://businesscentral.dynamics.com/7bcfb5b0-27a1-4e18-99d8-ca66570addd8/Production"
-BC_COMPANY = "PROD"
 BC_PAGE_ID = "9318"  # <-- Updated Page ID for Service Orders
 BC_RMA_FIELD_NAME = "RSMUS SDM ServReq No." # <-- Updated Field Name
 BC_LINK_COL_NAME = "View in BC" 
@@ -44,57 +45,56 @@ def load_data_from_google_sheet(
     worksheet_index=WORKSHEET_INDEX, 
     creds_file=CREDS_FILE
 ):
-    """Loads data from the specified Google Sheet."""
+    """Loads this page's rows from the specified Google Sheet; returns None if it can't be read."""
     try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/spreadsheets",
-                 "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scopes)
-        client = gspread.authorize(creds)
+        client = connect_to_google_sheet()
+        if client is None:
+            return None
         spreadsheet = client.open(sheet_name)
         worksheet = spreadsheet.get_worksheet(worksheet_index)
         
-        all_values = worksheet.get_all_values()
+        # Only the matching Part Number rows are downloaded when the filter is selective.
+        # Unformatted values: numbers stay numbers and dates arrive as serial numbers
+        all_values = fetch_matching_rows(
+            spreadsheet, worksheet, 'Part Number', lambda value: str(value) == 'CUST-TXCELL',
+            params={'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'SERIAL_NUMBER'}
+        )
         
         if not all_values:
             return pd.DataFrame(columns=EXPECTED_COLUMN_ORDER) 
             
         headers_from_sheet = all_values[0]
-        data_rows = all_values[1:]
+        # The API trims trailing blanks, so square the rows up to the header width
+        width = len(headers_from_sheet)
+        data_rows = [row[:width] + [''] * (width - len(row)) for row in all_values[1:]]
         
         temp_df = pd.DataFrame(data_rows, columns=headers_from_sheet)
-        df = pd.DataFrame(columns=EXPECTED_COLUMN_ORDER)
-
-        for col in EXPECTED_COLUMN_ORDER:
-            if col in temp_df.columns:
-                df[col] = temp_df[col] 
-            else: 
-                 if "Time" in col: df[col] = pd.NaT
-                 elif col in ALL_STATUS_COLUMNS: df[col] = "No"
-                 else: df[col] = "N/A" 
-        
-        df = df[EXPECTED_COLUMN_ORDER] 
-
-        string_cols_to_process = ['RMA', 'S/N', 'Part Number', 'SPC Code', 
-                                   'Description', 'Fault Comments', 'Resolution Comments', 
-                                   'Sender'] + ALL_STATUS_COLUMNS
-        for col in string_cols_to_process:
-            if col in df.columns:
-                df[col] = df[col].astype(str) 
-                if col in ALL_STATUS_COLUMNS:
-                     df[col] = df[col].replace(['', 'nan', 'None', 'NaN', 'NONE', None, 'NaT'], 'No') 
-                else: 
-                     df[col] = df[col].replace(['', 'nan', 'None', 'NaN', 'NONE', None, 'NaT'], 'N/A')
-
-        for col in ALL_TIME_COLUMNS:
-            if col in df.columns:
-                df[col] = df[col].replace('N/A', None) 
-                df[col] = pd.to_datetime(df[col], errors='coerce')
+        # Blank or repeated headers would break reindex; keep the first of each
+        temp_df = temp_df.loc[:, ~temp_df.columns.duplicated()]
+        # Pick and order the expected columns in one step; absent ones come back all-NaN
+        df = temp_df.reindex(columns=EXPECTED_COLUMN_ORDER)
+
+        # Clean each block of columns with one call instead of looping column by column
+        empty_values = ['', 'nan', 'None', 'NaN', 'NONE', None, 'NaT']
+        text_cols = ['RMA', 'S/N', 'Part Number', 'SPC Code', 
+                     'Description', 'Fault Comments', 'Resolution Comments', 'Sender']
+        # Columns outside the cleaned blocks (e.g. Reminder Contact Method) default to 'N/A' when absent
+        other_cols = [col for col in EXPECTED_COLUMN_ORDER if col not in text_cols + ALL_STATUS_COLUMNS + ALL_TIME_COLUMNS]
+        df[other_cols] = df[other_cols].fillna('N/A')
+        df[text_cols] = df[text_cols].astype(str).replace(empty_values, 'N/A')
+        df[ALL_STATUS_COLUMNS] = df[ALL_STATUS_COLUMNS].astype(str).replace(empty_values, 'No')
+        # Arrow-backed strings: the part-number filter and status masks run as Arrow compute kernels
+        arrow_cols = ['Part Number'] + ALL_STATUS_COLUMNS
+        df[arrow_cols] = df[arrow_cols].astype('string[pyarrow]')
+        # 'N/A' and blanks coerce to NaT
+        df[ALL_TIME_COLUMNS] = df[ALL_TIME_COLUMNS].apply(parse_sheet_datetimes)
         
         return df
     except Exception as e:
         st.error(f"An error occurred while loading data from Google Sheets: {type(e).__name__} - {e}")
-        return pd.DataFrame(columns=EXPECTED_COLUMN_ORDER) 
+        return None
 
+@st.cache_data(ttl=300)
 def create_excel_report(awaiting_qa_df, needs_approval_df):
     """Creates an Excel file with sheets for items awaiting QA and needing approval."""
     output = BytesIO()
@@ -102,24 +102,44 @@ def create_excel_report(awaiting_qa_df, needs_approval_df):
         workbook = writer.book
         header_format = workbook.add_format({'bold': True, 'text_wrap': True, 'valign': 'top', 'fg_color': '#D7E4BC', 'border': 1, 'align': 'center'})
         
-        needs_approval_df.to_excel(writer, sheet_name='Needs Approval', index=False)
-        worksheet_not_approved = writer.sheets['Needs Approval']
-        for col_num, value in enumerate(needs_approval_df.columns.values):
-            worksheet_not_approved.write(0, col_num, value, header_format)
-            if not needs_approval_df.empty:
-                max_len = max(needs_approval_df[value].astype(str).map(len).max(), len(value)) + 2
-                worksheet_not_approved.set_column(col_num, col_num, max_len)
-            
-        awaiting_qa_df.to_excel(writer, sheet_name='Approved (Awaiting QA)', index=False)
-        worksheet_approved = writer.sheets['Approved (Awaiting QA)']
-        for col_num, value in enumerate(awaiting_qa_df.columns.values):
-            worksheet_approved.write(0, col_num, value, header_format)
-            if not awaiting_qa_df.empty:
-                max_len = max(awaiting_qa_df[value].astype(str).map(len).max(), len(value)) + 2
-                worksheet_approved.set_column(col_num, col_num, max_len)
+        write_report_sheet(writer, needs_approval_df, 'Needs Approval', header_format)
+        write_report_sheet(writer, awaiting_qa_df, 'Approved (Awaiting QA)', header_format)
 
     return output.getvalue()
 
+@st.cache_data(ttl=300)
+def build_txcell_views(data_df, today):
+    """Filters the CUST-TXCELL records and builds the link column, status splits and day counts.
+
+    Cached on the loaded frame (and today's date) so widget reruns skip the rebuild.
+    """
+    filtered_df = data_df[data_df['Part Number'] == 'CUST-TXCELL']
+    if filtered_df.empty:
+        return filtered_df, filtered_df, filtered_df
+
+    filtered_df[BC_LINK_COL_NAME] = build_bc_links(filtered_df['RMA'], page_id=BC_PAGE_ID, field_name=BC_RMA_FIELD_NAME)
+    
+    # Lowercase each status column once and reuse it for both masks
+    approved_lc = filtered_df['Estimate Approved'].str.lower()
+    qa_lc = filtered_df['QA Approved'].str.lower()
+    needs_approval_df = filtered_df[approved_lc.eq('no')]
+    
+    awaiting_qa_df = filtered_df[
+        approved_lc.eq('yes') & qa_lc.eq('no')
+    ]
+
+    if not awaiting_qa_df.empty:
+        # Whole-day NumPy arithmetic; missing approval times stay blank (nullable Int64) and sort last
+        approved = awaiting_qa_df['Estimate Approved Time'].to_numpy(dtype='datetime64[ns]')
+        missing = np.isnat(approved)
+        elapsed_days = (np.datetime64(today, 'D') - approved.astype('datetime64[D]')).astype('int64')
+        awaiting_qa_df['Days Since Approval'] = pd.arrays.IntegerArray(elapsed_days, missing) if missing.any() else elapsed_days
+        # Order by the full timestamp (int64 nanoseconds), not the day
+        sort_key = np.where(missing, np.iinfo(np.int64).max, approved.view('int64'))
+        awaiting_qa_df = awaiting_qa_df.iloc[np.argsort(sort_key, kind='stable')]
+
+    return filtered_df, needs_approval_df, awaiting_qa_df
+
 # --- Main Application ---
 st.title("TXCELL Approval Status")
 st.markdown("This page tracks the approval and QA status for all service items with the part number `CUST-TXCELL`.")
@@ -130,31 +150,14 @@ if st.button("🔄 Refresh Data"):
 
 data_df = load_data_from_google_sheet()
 
-if data_df.empty:
+if data_df is None:
     st.warning("Could not load data from the Google Sheet. Please check the connection and sheet contents.")
 else:
-    filtered_df = data_df[data_df['Part Number'] == 'CUST-TXCELL'].copy()
+    filtered_df, needs_approval_df, awaiting_qa_df = build_txcell_views(data_df, date.today())
 
     if filtered_df.empty:
         st.info("✅ No service records found with the part number 'CUST-TXCELL'.")
     else:
-        filtered_df[BC_LINK_COL_NAME] = filtered_df.apply(
-            lambda row: f"{BC_BASE_URL}?company={BC_COMPANY}&page={BC_PAGE_ID}&filter='{urllib.parse.quote_plus(BC_RMA_FIELD_NAME)}'%20IS%20%27{urllib.parse.quote_plus(str(row['RMA']))}%27"
-            if pd.notna(row['RMA']) and str(row['RMA']).strip() != 'N/A' and str(row['RMA']).strip() != "" else None, axis=1
-        )
-        
-        needs_approval_df = filtered_df[filtered_df['Estimate Approved'].str.lower() == 'no']
-        
-        awaiting_qa_df = filtered_df[
-            (filtered_df['Estimate Approved'].str.lower() == 'yes') & 
-            (filtered_df['QA Approved'].str.lower() == 'no')
-        ].copy()
-
-        if not awaiting_qa_df.empty:
-            today_dt = pd.to_datetime(date.today()).normalize()
-            awaiting_qa_df['Days Since Approval'] = (today_dt - awaiting_qa_df['Estimate Approved Time'].dt.normalize()).dt.days
-            awaiting_qa_df = awaiting_qa_df.sort_values(by='Estimate Approved Time', ascending=True)
-
         st.markdown("---")
         kpi1, kpi2, btn_col = st.columns([1, 1, 2])
         kpi1.metric(label="Waiting for Approval", value=len(needs_approval_df))
@@ -170,6 +173,13 @@ else:
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 use_container_width=True
             )
+            st.download_button(
+                label="📦 Download as Parquet (fast)",
+                data=create_parquet_report_bytes({'Needs Approval': needs_approval_df, 'Approved (Awaiting QA)': awaiting_qa_df}),
+                file_name=f"CUST-TXCELL_Action_Report_{date.today().strftime('%Y-%m-%d')}.parquet",
+                mime="application/vnd.apache.parquet",
+                use_container_width=True
+            )
         st.markdown("---")
 
         st.subheader("Estimates Not Approved")
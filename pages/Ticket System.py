@@ -1,80 +1,85 @@
 # pages/Ticket_System.py
 
+import time
 import streamlit as st
 import pandas as pd
-from logic import send_ticket_reply_and_log, update_ticket_status
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import urllib.parse
+from logic import (
+    RMA_REGEX, send_ticket_reply_and_log, update_ticket_status, build_bc_links,
+    connect_to_tickets_sheet, load_tickets, get_status_options, filter_tickets, ticket_details, TICKET_BC_LINK_COL_NAME
+)
 
 # --- Page Config ---
 st.set_page_config(page_title="Ticketing System", layout="wide")
 st.title("🎫 Customer Ticket System")
 
-# --- Business Central Constants for Link Generation ---
-BC_BASE_URL = "https://businesscentral.dynamics.com/7bcfb5b0-27a1-4e18-99d8-ca66570addd8/Production"
-BC_COMPANY = "PROD"
-BC_PAGE_ID = "70001" 
-BC_RMA_FIELD_NAME = "No."
-BC_LINK_COL_NAME = "Business Central Link" 
-
-# --- Google Sheets Connection Functions ---
-@st.cache_resource(ttl=300)
-def connect_and_get_sheet():
-    """Connects to Google Sheets and returns the 'Tickets' worksheet object."""
-    try:
-        scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
-                 "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
-        client = gspread.authorize(creds)
-        sheet = client.open("Estimate form").worksheet("Tickets")
-        return sheet
-    except Exception as e:
-        st.error(f"Could not connect to Google Sheets: {e}")
-        return None
-
-@st.cache_data(ttl=60)
-def load_tickets(_sheet):
-    """Loads all ticket records from the worksheet into a DataFrame."""
-    if _sheet is None:
-        return pd.DataFrame()
-    records = _sheet.get_all_records()
-    return pd.DataFrame(records)
+# A reply sent on the previous run clears the form and reruns; show its confirmation here
+reply_confirmation = st.session_state.pop("reply_confirmation", None)
+if reply_confirmation:
+    st.success(reply_confirmation)
+
+# --- Session edits ---
+def record_ticket_edit(ticket_id, **fields):
+    """Remembers values this session just wrote to the sheet, so they show without reloading every ticket."""
+    edits = st.session_state.setdefault("ticket_edits", {})
+    _, pending = edits.get(ticket_id, (None, {}))
+    edits[ticket_id] = (time.time(), {**pending, **fields})
+
+def apply_ticket_edits(df_tickets):
+    """Overlays this session's edits on the cached tickets; edits older than the load are already in it."""
+    edits = st.session_state.get("ticket_edits", {})
+    loaded_at = df_tickets.attrs.get("loaded_at", 0)
+    for ticket_id, (edited_at, fields) in list(edits.items()):
+        if edited_at <= loaded_at:
+            del edits[ticket_id]
+        elif ticket_id in df_tickets.index:
+            for col, value in fields.items():
+                if col not in df_tickets.columns:
+                    continue
+                # Categorical columns (Status) only accept known values
+                if isinstance(df_tickets[col].dtype, pd.CategoricalDtype) and value not in df_tickets[col].cat.categories:
+                    df_tickets[col] = df_tickets[col].cat.add_categories([value])
+                df_tickets.loc[ticket_id, col] = value
+    return df_tickets
 
 # --- Main App ---
-sheet = connect_and_get_sheet()
+sheet = connect_to_tickets_sheet()
 
 if sheet:
-    df_tickets = load_tickets(sheet)
+    # Tickets are cached for up to 15 minutes; refresh to pick up new tickets and other agents' changes sooner
+    if st.sidebar.button("🔄 Refresh Tickets"):
+        load_tickets.clear()
+    df_tickets = apply_ticket_edits(load_tickets(sheet))
 
     if df_tickets.empty:
         st.info("No tickets found.")
     else:
         # --- DYNAMICALLY CREATE THE LINK COLUMN ---
         if 'RMA' in df_tickets.columns:
-            df_tickets[BC_LINK_COL_NAME] = df_tickets['RMA'].apply(
-                lambda rma: f"{BC_BASE_URL}?company={BC_COMPANY}&page={BC_PAGE_ID}&filter='{urllib.parse.quote_plus(BC_RMA_FIELD_NAME)}'%20IS%20%27{urllib.parse.quote_plus(str(rma))}%27"
-                if pd.notna(rma) and str(rma).strip() != "" else None
-            )
+            df_tickets[TICKET_BC_LINK_COL_NAME] = build_bc_links(df_tickets['RMA'])
         
         # --- Sidebar and Filtering ---
         st.sidebar.header("Filter Tickets")
         if "Status" in df_tickets.columns:
-            status_filter = st.sidebar.selectbox("Filter by Status", options=["All"] + df_tickets["Status"].unique().tolist())
-            if status_filter != "All":
-                df_filtered = df_tickets[df_tickets["Status"] == status_filter]
-            else:
-                df_filtered = df_tickets
+            status_filter = st.sidebar.selectbox("Filter by Status", options=get_status_options(df_tickets))
         else:
             st.error("The 'Tickets' sheet is missing a 'Status' column.")
-            df_filtered = df_tickets
+            status_filter = "All"
+        keyword = st.sidebar.text_input("Search Subject / Message").strip()
+        # Cached per (tickets, status, keyword), so reruns from typing a reply skip the masks and option build
+        df_filtered, ticket_subjects = filter_tickets(df_tickets, status_filter, keyword)
+        if df_filtered.empty:
+            # Nothing to list or reply to: skip the table, selectbox and reply form
+            st.info("No tickets match the current filters.")
+            st.stop()
 
         # --- Display the Dataframe ---
+        # Slice to the shown columns so the long Body text isn't serialised to Arrow on every rerun
+        table_columns = ["Ticket ID", "Status", "RMA", "Serial Number", TICKET_BC_LINK_COL_NAME, "Customer Email", "Subject"]
         st.dataframe(
-            df_filtered,
-            column_order=("Ticket ID", "Status", "RMA","Serial Number", BC_LINK_COL_NAME, "Customer Email", "Subject"),
+            df_filtered[[col for col in table_columns if col in df_filtered.columns]],
+            column_order=table_columns,
             column_config={
-                BC_LINK_COL_NAME: st.column_config.LinkColumn(
+                TICKET_BC_LINK_COL_NAME: st.column_config.LinkColumn(
                     "View in BC",
                     display_text="Open Link"
                 )
@@ -86,13 +91,18 @@ if sheet:
 
         # --- Reply Section ---
         st.header("Reply to a Ticket")
-        
-        ticket_options = [f"{row['Ticket ID']}: {row['Subject']}" for index, row in df_filtered.iterrows()]
-        selected_ticket_str = st.selectbox("Select a ticket to reply to", options=[""] + ticket_options)
 
-        if selected_ticket_str:
-            ticket_id_to_reply = selected_ticket_str.split(":")[0]
-            ticket_data = df_tickets[df_tickets["Ticket ID"] == ticket_id_to_reply].iloc[0]
+        # The selectbox value is the Ticket ID itself; the label is only formatted for display
+        ticket_id_to_reply = st.selectbox(
+            "Select a ticket to reply to",
+            options=[""] + list(ticket_subjects),
+            format_func=lambda tid: f"{tid}: {ticket_subjects[tid]}" if tid else "",
+            key="ticket_view_id"
+        )
+
+        if ticket_id_to_reply:
+            # Plain dict access on every rerun instead of pulling fields off a row Series
+            ticket_data = ticket_details(df_tickets)[ticket_id_to_reply]
 
             st.subheader(f"Replying to Ticket: {ticket_data['Ticket ID']}")
             st.write(f"**From:** {ticket_data['Customer Email']}")
@@ -107,7 +117,7 @@ if sheet:
                     success, message = update_ticket_status(sheet, ticket_data['Ticket ID'], "In Progress")
                     if success:
                         st.success(message)
-                        load_tickets.clear()
+                        record_ticket_edit(ticket_data['Ticket ID'], Status="In Progress")
                     else:
                         st.error(message)
             with col2:
@@ -115,7 +125,7 @@ if sheet:
                     success, message = update_ticket_status(sheet, ticket_data['Ticket ID'], "Closed")
                     if success:
                         st.success(message)
-                        load_tickets.clear()
+                        record_ticket_edit(ticket_data['Ticket ID'], Status="Closed")
                     else:
                         st.error(message)
 
@@ -124,7 +134,7 @@ if sheet:
                     "Select your name (for email signature and logs)",
                     options=st.secrets.get("users", {}).get("team_members", ["Default User"])
                 )
-                reply_text = st.text_area("Your Reply:", height=200)
+                reply_text = st.text_area("Your Reply:", height=200, key="reply_text")
                 submitted = st.form_submit_button("Send Reply")
 
                 if submitted:
@@ -141,8 +151,15 @@ if sheet:
                                 team_member_name=team_member
                             )
                             if success:
-                                st.success(message)
-                                load_tickets.clear()
+                                # Mirror what the reply log wrote instead of refetching the whole sheet
+                                rma_match = RMA_REGEX.search(reply_text)
+                                rma_edit = {"RMA": rma_match.group(1)} if rma_match else {}
+                                record_ticket_edit(ticket_data['Ticket ID'], Status="In Progress", **rma_edit)
+                                # Clear the reply and the selection only once it was sent, so a failed send keeps the text
+                                st.session_state["reply_confirmation"] = message
+                                st.session_state.pop("reply_text", None)
+                                st.session_state.pop("ticket_view_id", None)
+                                st.rerun()
                             else:
                                 st.error(message)
 # This 'else' block prevents a blank page if the connection fails